@@ -25,6 +25,10 @@ def parse_args():
     """init."""
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_url', type=str, default="./data", help='')
+    parser.add_argument('--features_cache_dir', type=str, default=None,
+                        help='directory caching the converted ReCoRD features, disabled if not set')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes converting ReCoRD examples to features')
 
     args = parser.parse_args()
     return args
@@ -42,7 +46,9 @@ def convert_record_train_data():
         max_seq_length=384,
         in_tokens=False,
         doc_stride=128,
-        max_query_length=64)
+        max_query_length=64,
+        cache_dir=args.features_cache_dir,
+        num_workers=args.num_workers)
 
     print("record train data process begin")
     train_concept_settings = {
@@ -109,7 +115,9 @@ def convert_record_predict_data():
         max_seq_length=384,
         in_tokens=False,
         doc_stride=128,
-        max_query_length=64)
+        max_query_length=64,
+        cache_dir=args.features_cache_dir,
+        num_workers=args.num_workers)
 
     print("record predict data process begin")
     eval_concept_settings = {
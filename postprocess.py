@@ -35,6 +35,10 @@ parser.add_argument("--dataset", type=str, default="squad", help="dataset")
 parser.add_argument("--data_url", type=str, default="./data", help="data url")
 parser.add_argument("--checkpoints", type=str, default="log/eval_310",
                     help="Path to save checkpoints.")
+parser.add_argument("--features_cache_dir", type=str, default=None,
+                    help="directory caching the converted ReCoRD features, disabled if not set")
+parser.add_argument("--num_workers", type=int, default=1,
+                    help="number of processes converting ReCoRD examples to features and predicting their answers")
 
 args, _ = parser.parse_known_args()
 
@@ -104,7 +108,9 @@ if __name__ == "__main__":
             max_seq_length=384,
             in_tokens=False,
             doc_stride=128,
-            max_query_length=64)
+            max_query_length=64,
+            cache_dir=args.features_cache_dir,
+            num_workers=args.num_workers)
 
         eval_data = processor.data_generator(
             data_path=args.data_url + '/ReCoRD/dev.json',
@@ -166,7 +172,7 @@ if __name__ == "__main__":
                                                20, 30, False, output_prediction_file,
                                                output_nbest_file, output_null_log_odds_file,
                                                False, 0.0, False, args.data_url + '/ReCoRD/dev.json',
-                                               output_evaluation_result_file)
+                                               output_evaluation_result_file, num_workers=args.num_workers)
     print("==============================================================")
     print(eval_result)
     print("==============================================================")
@@ -110,6 +110,10 @@ def parse_args():
     data_g.add_arg("null_score_diff_threshold", float, 0.0,
                    "If null_score - best_non_null is greater than the threshold predict null.")
     data_g.add_arg("random_seed", int, 45, "Random seed.")
+    data_g.add_arg("features_cache_dir", str, None,
+                   "Directory caching the converted features across runs, disabled if not set.")
+    data_g.add_arg("num_workers", int, 1,
+                   "Number of processes converting examples to features and predicting their answers.")
 
     run_type_g = ArgumentGroup(parser, "run_type", "running type options.")
     run_type_g.add_arg("do_train", bool, False, "Whether to perform training.")
@@ -230,7 +234,7 @@ def do_eval(processor, eval_concept_settings, eval_output_name='eval_result.json
                                     output_nbest_file, output_null_log_odds_file,
                                     args.version_2_with_negative,
                                     args.null_score_diff_threshold, args.verbose, args.predict_file,
-                                    output_evaluation_result_file)
+                                    output_evaluation_result_file, num_workers=args.num_workers)
     print("==============================================================")
     print(eval_result)
     print("==============================================================")
@@ -291,7 +295,9 @@ def run_KTNET():
             max_seq_length=args.max_seq_len,
             in_tokens=args.in_tokens,
             doc_stride=args.doc_stride,
-            max_query_length=args.max_query_length)
+            max_query_length=args.max_query_length,
+            cache_dir=args.features_cache_dir,
+            num_workers=args.num_workers)
 
         do_eval(processor, eval_concept_settings, network=KTNET_eval,
                 load_checkpoint_path=args.load_checkpoint_path)
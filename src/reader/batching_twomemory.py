@@ -75,7 +75,26 @@ def mask(batch_tokens, total_token_num, vocab_size, CLS=1, SEP=2, MASK=3):
     return batch_tokens, mask_labels, mask_pos
 
 
-def prepare_batch_data(insts,
+def new_batch():
+    """
+    Returns an empty batch laid out field by field: one list of per-example
+    arrays for every model input and one label tuple per example.
+    """
+    return {"src_ids": [], "sent_ids": [], "pos_ids": [], "wn_concept_ids": [], "nell_concept_ids": [],
+            "labels": []}
+
+
+def add_to_batch(batch, src_ids, sent_ids, pos_ids, wn_concept_ids, nell_concept_ids, labels):
+    """Appends the fields of one example to a batch made by `new_batch`."""
+    batch["src_ids"].append(src_ids)
+    batch["sent_ids"].append(sent_ids)
+    batch["pos_ids"].append(pos_ids)
+    batch["wn_concept_ids"].append(wn_concept_ids)
+    batch["nell_concept_ids"].append(nell_concept_ids)
+    batch["labels"].append(labels)
+
+
+def prepare_batch_data(batch,
                        total_token_num,
                        voc_size=0,
                        pad_id=None,
@@ -90,19 +109,15 @@ def prepare_batch_data(insts,
     3. generate self attention mask, [shape: batch_size *  max_len * max_len]
     """
 
-    batch_src_ids = [inst[0] for inst in insts]
-    batch_sent_ids = [inst[1] for inst in insts]
-    batch_pos_ids = [inst[2] for inst in insts]
-    batch_wn_concept_ids = [inst[3] for inst in insts]
-    batch_nell_concept_ids = [inst[4] for inst in insts]
-    labels_list = []
+    batch_src_ids = batch["src_ids"]
+    batch_sent_ids = batch["sent_ids"]
+    batch_pos_ids = batch["pos_ids"]
+    batch_wn_concept_ids = batch["wn_concept_ids"]
+    batch_nell_concept_ids = batch["nell_concept_ids"]
     # compatible with squad, whose example includes start/end positions,
     # or unique id
-
-    for i in range(5, len(insts[0]), 1):
-        labels = [inst[i] for inst in insts]
-        labels = np.array(labels).astype("int64").reshape([-1, 1])
-        labels_list.append(labels)
+    labels = np.array(batch["labels"]).astype("int64")
+    labels_list = [labels[:, i:i + 1] for i in range(labels.shape[1])]
 
     # First step: do mask without padding
     if mask_id >= 0:
@@ -118,11 +133,17 @@ def prepare_batch_data(insts,
     # Second step: padding
     src_id, self_input_mask = pad_batch_data(
         out, pad_idx=pad_id, return_input_mask=True)
-    pos_id = pad_batch_data(
-        batch_pos_ids,
-        pad_idx=pad_id,
-        return_pos=False,
-        return_input_mask=False)
+    shared_pos_ids = batch_pos_ids[0]
+    if len(shared_pos_ids) == 384 and all(inst is shared_pos_ids for inst in batch_pos_ids):
+        # every example references the same full-length position ids
+        pos_id = np.tile(np.asarray(shared_pos_ids, dtype="int64"), (len(batch_pos_ids), 1))
+        pos_id = pos_id.reshape([-1, 384, 1])
+    else:
+        pos_id = pad_batch_data(
+            batch_pos_ids,
+            pad_idx=pad_id,
+            return_pos=False,
+            return_input_mask=False)
     sent_id = pad_batch_data(
         batch_sent_ids,
         pad_idx=pad_id,
@@ -161,15 +182,23 @@ def pad_batch_data(insts,
     # Any token included in dict can be used to pad, since the paddings' loss
     # will be masked out by weights and make no effect on parameter gradients.
 
+    # Instances may be python lists or numpy arrays; they are concatenated and
+    # scattered into a preallocated batch buffer in a single assignment.
+    inst_lens = np.array([len(inst) for inst in insts])
+    valid = np.arange(max_len)[np.newaxis, :] < inst_lens[:, np.newaxis]
+    non_empty = [inst for inst in insts if len(inst)]
     if isinstance(pad_idx, list):  # padding list, for concept_ids
-        inst_data = np.array(
-            [inst + list([0] * max_concept_length for x in range(max_len - len(inst))) for inst in insts])
-        return_list += [inst_data.astype("int64").reshape([-1, max_len, max_concept_length, 1])]
+        inst_data = np.zeros([len(insts), max_len, max_concept_length], dtype="int64")
+        if non_empty:
+            inst_data[valid] = np.concatenate(non_empty)
+        # the batch size is spelled out, since -1 cannot be inferred for a disabled
+        # concept source whose max_concept_length is 0
+        return_list += [inst_data.reshape([len(insts), max_len, max_concept_length, 1])]
     else:
-        inst_data = np.array([
-            list(inst) + list([pad_idx] * (max_len - len(inst))) for inst in insts
-        ])
-        return_list += [inst_data.astype("int64").reshape([-1, max_len, 1])]
+        inst_data = np.full([len(insts), max_len], pad_idx, dtype="int64")
+        if non_empty:
+            inst_data[valid] = np.concatenate(non_empty)
+        return_list += [inst_data.reshape([-1, max_len, 1])]
 
     # position data
     if return_pos:
@@ -182,9 +211,7 @@ def pad_batch_data(insts,
 
     if return_input_mask:
         # This is used to avoid attention on paddings.
-        input_mask_data = np.array([[1] * len(inst) + [0] *
-                                    (max_len - len(inst)) for inst in insts])
-        input_mask_data = np.expand_dims(input_mask_data, axis=-1)
+        input_mask_data = np.expand_dims(valid, axis=-1)
         return_list += [input_mask_data.astype("float32")]
 
     if return_max_len:
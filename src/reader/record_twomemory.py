@@ -14,18 +14,28 @@
 # ============================================================================
 """Run BERT on ReCoRD."""
 
-import math
 import json
+import functools
+import itertools
 import random
-import collections
 import os
 import pickle
+import hashlib
+import struct
+import heapq
+import multiprocessing
 import logging
-import six
+import ijson
+import numpy as np
 import src.reader.tokenization as tokenization
-from src.reader.batching_twomemory import prepare_batch_data
+from src.reader.batching_twomemory import new_batch, add_to_batch, prepare_batch_data
 
-from src.reader.record_official_evaluate import evaluate, f1_score
+from src.reader.record_official_evaluate import evaluate, normalize_answer
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, fall back to the standard library parser
+    from json import loads as json_loads
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -60,18 +70,15 @@ class ReCoRDExample:
         return self.__repr__()
 
     def __repr__(self):
-        s = ""
-        s += "qas_id: %s" % (tokenization.printable_text(self.qas_id))
-        s += ", question_text: %s" % (
-            tokenization.printable_text(self.question_text))
-        s += ", doc_tokens: [%s]" % (" ".join(self.doc_tokens))
-        if self.start_position:
-            s += ", start_position: %d" % (self.start_position)
-        if self.start_position:
-            s += ", end_position: %d" % (self.end_position)
-        if self.start_position:
-            s += ", is_impossible: %r" % (self.is_impossible)
-        return s
+        parts = [f"qas_id: {self.qas_id}",
+                 f"question_text: {self.question_text}",
+                 f"doc_tokens: [{' '.join(self.doc_tokens)}]"]
+        if self.start_position is not None:
+            parts.append(f"start_position: {self.start_position:d}")
+        if self.end_position is not None:
+            parts.append(f"end_position: {self.end_position:d}")
+        parts.append(f"is_impossible: {self.is_impossible!r}")
+        return ", ".join(parts)
 
 
 class InputFeatures:
@@ -82,8 +89,8 @@ class InputFeatures:
                  example_index,
                  doc_span_index,
                  tokens,
-                 token_to_orig_map,
-                 token_is_max_context,
+                 token_to_orig_arr,
+                 token_is_max_context_arr,
                  input_ids,
                  input_mask,
                  segment_ids,
@@ -96,8 +103,10 @@ class InputFeatures:
         self.example_index = example_index
         self.doc_span_index = doc_span_index
         self.tokens = tokens
-        self.token_to_orig_map = token_to_orig_map
-        self.token_is_max_context = token_is_max_context
+        # the original doc token of every token (-1 outside the document), and
+        # whether this doc span is its max context (False outside the document)
+        self.token_to_orig_arr = token_to_orig_arr
+        self.token_is_max_context_arr = token_is_max_context_arr
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
@@ -108,99 +117,125 @@ class InputFeatures:
         self.nell_concept_ids = nell_concept_ids
 
 
-def read_record_examples(input_file, is_training, version_2_with_negative=False):
-    """Read a ReCoRD json file into a list of ReCoRDExample."""
-    with open(input_file, "r") as reader:
-        input_data = json.load(reader)["data"]
+# lookup table marking the whitespace code points, its last entry (0x2030) stands for
+# every larger code point, which are all non-whitespace
+_WHITESPACE_TABLE = np.zeros(0x2031, dtype=np.bool_)
+_WHITESPACE_TABLE[[0x20, 0x09, 0x0A, 0x0D, 0x202F]] = True
 
-    def is_whitespace(c):
-        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-            return True
-        return False
 
-    examples = []
-    for entry in input_data:
-        paragraph_text = entry["passage"]["text"].replace('\xa0', ' ')
-        doc_tokens = []
-        char_to_word_offset = []
-        prev_is_whitespace = True
-        for c in paragraph_text:
-            if is_whitespace(c):
-                prev_is_whitespace = True
+def _split_ws(codes):
+    """Split a paragraph, given as an array of code points, on whitespace.
+
+    Returns the word offset of every character, and the start and (exclusive)
+    end character offsets of every whitespace-delimited token.
+    """
+    is_token_char = ~np.take(_WHITESPACE_TABLE, codes, mode='clip')
+    prev_is_whitespace = np.concatenate(([True], ~is_token_char[:-1]))
+    next_is_whitespace = np.concatenate((~is_token_char[1:], [True]))
+    is_token_start = is_token_char & prev_is_whitespace
+    char_to_word_offset = np.cumsum(is_token_start, dtype=np.int32) - 1
+    token_starts = np.flatnonzero(is_token_start)
+    token_ends = np.flatnonzero(is_token_char & next_is_whitespace) + 1
+    return char_to_word_offset, token_starts, token_ends
+
+
+def read_record_examples(input_file, is_training, version_2_with_negative=False):
+    """Read a ReCoRD json file, yielding ReCoRDExamples one passage at a time."""
+    with open(input_file, "rb") as reader:
+        for entry in ijson.items(reader, "data.item"):
+            yield from _read_record_entry(entry, is_training, version_2_with_negative)
+
+
+def _read_record_entry(entry, is_training, version_2_with_negative):
+    """Convert a single ReCoRD passage entry into ReCoRDExamples."""
+    paragraph_text = entry["passage"]["text"].replace('\xa0', ' ')
+    codes = np.frombuffer(paragraph_text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    char_to_word_offset, token_starts, token_ends = _split_ws(codes)
+    doc_tokens = [paragraph_text[start:end] for start, end in zip(token_starts.tolist(), token_ends.tolist())]
+
+    for qa in entry["qas"]:
+        qas_id = qa["id"]
+        question_text = qa["query"].replace('\xa0', ' ')
+        start_position = None
+        end_position = None
+        orig_answer_text = None
+        is_impossible = False
+        if is_training:
+
+            if version_2_with_negative:
+                is_impossible = qa["is_impossible"]
+            # if (len(qa["answers"]) != 1) and (not is_impossible):
+            #     raise ValueError(
+            #         "For training, each question should have exactly 1 answer."
+            #     )
+            if not is_impossible:
+                answer = qa["answers"][0]
+                orig_answer_text = answer["text"]
+                answer_offset = answer["start"]
+                answer_length = len(orig_answer_text)
+                start_position = int(char_to_word_offset[answer_offset])
+                end_position = int(char_to_word_offset[answer_offset +
+                                                       answer_length - 1])
+                # Only add answers where the text can be exactly recovered from the
+                # document. If this CAN'T happen it's likely due to weird Unicode
+                # stuff so we will just skip the example.
+                #
+                # Note that this means for training mode, every example is NOT
+                # guaranteed to be preserved.
+                actual_text = " ".join(doc_tokens[start_position:(end_position + 1)])
+                cleaned_answer_text = " ".join(
+                    tokenization.whitespace_tokenize(orig_answer_text))
+                if actual_text.find(cleaned_answer_text) == -1:
+                    logger.info("Could not find answer: '%s' vs. '%s'",
+                                actual_text, cleaned_answer_text)
+                    continue
             else:
-                if prev_is_whitespace:
-                    doc_tokens.append(c)
-                else:
-                    doc_tokens[-1] += c
-                prev_is_whitespace = False
-            char_to_word_offset.append(len(doc_tokens) - 1)
+                start_position = -1
+                end_position = -1
+                orig_answer_text = ""
+
+        example = ReCoRDExample(
+            qas_id=qas_id,
+            question_text=question_text,
+            doc_tokens=doc_tokens,
+            orig_answer_text=orig_answer_text,
+            start_position=start_position,
+            end_position=end_position,
+            is_impossible=is_impossible)
+        yield example
+
+
+# position ids of a full-length sequence, shared by every batched example
+_POSITION_IDS = np.arange(384, dtype=np.int32)
+
+# the tokenization and retrieval pickles run to hundreds of MB for ReCoRD
+_PICKLE_READ_BUFFER_SIZE = 1 << 22
 
-        for qa in entry["qas"]:
-            qas_id = qa["id"]
-            question_text = qa["query"].replace('\xa0', ' ')
-            start_position = None
-            end_position = None
-            orig_answer_text = None
-            is_impossible = False
-            if is_training:
-
-                if version_2_with_negative:
-                    is_impossible = qa["is_impossible"]
-                # if (len(qa["answers"]) != 1) and (not is_impossible):
-                #     raise ValueError(
-                #         "For training, each question should have exactly 1 answer."
-                #     )
-                if not is_impossible:
-                    answer = qa["answers"][0]
-                    orig_answer_text = answer["text"]
-                    answer_offset = answer["start"]
-                    answer_length = len(orig_answer_text)
-                    start_position = char_to_word_offset[answer_offset]
-                    end_position = char_to_word_offset[answer_offset +
-                                                       answer_length - 1]
-                    # Only add answers where the text can be exactly recovered from the
-                    # document. If this CAN'T happen it's likely due to weird Unicode
-                    # stuff so we will just skip the example.
-                    #
-                    # Note that this means for training mode, every example is NOT
-                    # guaranteed to be preserved.
-                    actual_text = " ".join(doc_tokens[start_position:(end_position + 1)])
-                    cleaned_answer_text = " ".join(
-                        tokenization.whitespace_tokenize(orig_answer_text))
-                    if actual_text.find(cleaned_answer_text) == -1:
-                        logger.info("Could not find answer: '%s' vs. '%s'",
-                                    actual_text, cleaned_answer_text)
-                        continue
-                else:
-                    start_position = -1
-                    end_position = -1
-                    orig_answer_text = ""
-
-            example = ReCoRDExample(
-                qas_id=qas_id,
-                question_text=question_text,
-                doc_tokens=doc_tokens,
-                orig_answer_text=orig_answer_text,
-                start_position=start_position,
-                end_position=end_position,
-                is_impossible=is_impossible)
-            examples.append(example)
 
-    return examples
+def _load_pickle(path):
+    """Loads a pickle through a large read buffer and closes the file afterwards."""
+    with open(path, 'rb', buffering=_PICKLE_READ_BUFFER_SIZE) as reader:
+        return pickle.load(reader)
 
 
 class Examples_To_Features_Converter:
     """Examples to features converter"""
-    def __init__(self, **concept_settings):
+    def __init__(self, trust_offline_tokenization=True, **concept_settings):
         self.concept_settings = concept_settings
+        # take the document subtokens from the offline tokenization, checked against
+        # the online tokenization once per passage rather than once per query
+        self.trust_offline_tokenization = trust_offline_tokenization
+
+        # memoized tokenizer and per-passage results reused across examples
+        self._word_tokenizer = None
+        self._doc_cache = None
+        self._doc_wn_cache = None
 
         # load necessary data files for mapping to related concepts
         # 1. mapping from subword-level tokenization to word-level tokenization
         tokenization_filepath = self.concept_settings['tokenization_path']
         assert os.path.exists(tokenization_filepath)
-        self.all_tokenization_info = {}
-        for item in pickle.load(open(tokenization_filepath, 'rb')):
-            self.all_tokenization_info[item['id']] = item
+        self.all_tokenization_info = {item['id']: item for item in _load_pickle(tokenization_filepath)}
 
         # 2. mapping from concept name to concept id
         self.wn_concept2id = self.concept_settings['wn_concept2id']
@@ -210,47 +245,125 @@ class Examples_To_Features_Converter:
         if concept_settings['use_wordnet']:
             retrieved_synset_filepath = self.concept_settings['retrieved_synset_path']
             assert os.path.exists(retrieved_synset_filepath)
-            self.synsets_info = pickle.load(open(retrieved_synset_filepath, 'rb'))  # token to sysnet names
+            self.synsets_info = _load_pickle(retrieved_synset_filepath)  # token to sysnet names
             self.max_wn_concept_length = max([len(synsets) for synsets in self.synsets_info.values()])
+            # dense (token row, concept) id matrix, row 0 is left empty for tokens without synsets
+            self.wn_token2row = {token: row for row, token in enumerate(self.synsets_info, start=1)}
+            self.wn_mat = np.zeros((len(self.wn_token2row) + 1, self.max_wn_concept_length), dtype=np.int32)
+            for token, row in self.wn_token2row.items():
+                synsets = self.synsets_info[token]
+                self.wn_mat[row, :len(synsets)] = [self.wn_concept2id[synset_name] for synset_name in synsets]
 
         # 4. retrieved related nell concepts (if use_nell)
         if concept_settings['use_nell']:
             retrieved_nell_concept_filepath = self.concept_settings['retrieved_nell_concept_path']
             assert os.path.exists(retrieved_nell_concept_filepath)
-            self.nell_retrieve_info = {}
-            for item in pickle.load(open(retrieved_nell_concept_filepath, 'rb')):
-                self.nell_retrieve_info[item['id']] = item
+            self.nell_retrieve_info = {item['id']: item for item in _load_pickle(retrieved_nell_concept_filepath)}
             self.max_nell_concept_length = max([max([len(entity_info['retrieved_concepts']) for entity_info in
                                                      item['query_entities'] + item['document_entities']])
                                                 for qid, item in self.nell_retrieve_info.items() if
                                                 item['query_entities'] + item['document_entities']])
 
-    # return list of concept ids given input subword list
+        # resolve the concept settings once here, so that converting an example
+        # does not re-check them and disabled concepts yield empty id rows
+        if concept_settings['use_wordnet']:
+            self._query_wordnet_concepts = self._lookup_query_wordnet_concepts
+            self._doc_wordnet_concepts = self._lookup_doc_wordnet_concepts
+        else:
+            self.max_wn_concept_length = 0
+            self._query_wordnet_concepts = self._doc_wordnet_concepts = self._no_concepts
+        if concept_settings['use_nell']:
+            self._query_nell_concepts = self._lookup_query_nell_concepts
+            self._doc_nell_concepts = self._lookup_doc_nell_concepts
+        else:
+            self.max_nell_concept_length = 0
+            self._query_nell_concepts = self._doc_nell_concepts = self._no_concepts
+
+    # return padded concept id array of shape (len(sub_tokens), max_wn_concept_length) given input subword list
     def _lookup_wordnet_concept_ids(self, sub_tokens, sub_to_ori_index, tokens, tolower, tokenizer):
         """lookup wordnet concept ids"""
-        concept_ids = []
+        rows = []
         for index in range(len(sub_tokens)):
             original_token = tokens[sub_to_ori_index[index]]
             # if tokens are in upper case, we must lower it for retrieving
             retrieve_token = tokenizer.basic_tokenizer.run_strip_accents(
                 original_token.lower()) if tolower else original_token
-            if retrieve_token in self.synsets_info:
-                concept_ids.append(
-                    [self.wn_concept2id[synset_name] for synset_name in self.synsets_info[retrieve_token]])
-            else:
-                concept_ids.append([])
-        return concept_ids
+            rows.append(self.wn_token2row.get(retrieve_token, 0))
+        return self.wn_mat[np.asarray(rows, dtype=np.int64)]
 
+    # return padded concept id array of shape (len(sub_tokens), max_nell_concept_length) given input subword list
     def _lookup_nell_concept_ids(self, sub_tokens, sub_to_ori_index, tokens, nell_info):
-        original_concept_ids = [[] for _ in range(len(tokens))]
+        """lookup nell concept ids"""
+        positions = []
+        concept_ids = []
         for entity_info in nell_info:
+            entity_concept_ids = [self.nell_concept2id[category_name] for category_name in
+                                  entity_info['retrieved_concepts']]
             for pos in range(entity_info['token_start'], entity_info['token_end'] + 1):
-                original_concept_ids[pos] += [self.nell_concept2id[category_name] for category_name in
-                                              entity_info['retrieved_concepts']]
-        for pos, original_concept_id in enumerate(original_concept_ids):
-            original_concept_ids[pos] = list(set(original_concept_id))
-        concept_ids = [original_concept_ids[sub_to_ori_index[index]] for index in range(len(sub_tokens))]
-        return concept_ids
+                positions += [pos] * len(entity_concept_ids)
+                concept_ids += entity_concept_ids
+
+        original_concept_ids = np.zeros((len(tokens), self.max_nell_concept_length), dtype=np.int32)
+        if concept_ids:
+            # deduplicate the (position, concept id) pairs of all entities in one pass, the
+            # result is sorted by position so each pair's column is its rank within its position
+            num_concepts = max(concept_ids) + 1
+            pairs = np.unique(np.asarray(positions, dtype=np.int64) * num_concepts + concept_ids)
+            positions, concept_ids = np.divmod(pairs, num_concepts)
+            columns = np.arange(len(pairs)) - np.searchsorted(positions, positions)
+            kept = columns < self.max_nell_concept_length
+            original_concept_ids[positions[kept], columns[kept]] = concept_ids[kept]
+        return original_concept_ids[np.asarray(sub_to_ori_index[:len(sub_tokens)], dtype=np.int64)]
+
+    def _lookup_query_wordnet_concepts(self, example, tokenization_info, sub_tokens, tokenizer):
+        """lookup wordnet concept ids of the query"""
+        # if tolower is True, tokenizer must be given
+        return self._lookup_wordnet_concept_ids(sub_tokens,
+                                                tokenization_info['query_sub_to_ori_index'],
+                                                tokenization_info['query_tokens'],
+                                                tolower=not tokenizer.basic_tokenizer.do_lower_case,
+                                                tokenizer=tokenizer)
+
+    def _lookup_doc_wordnet_concepts(self, example, tokenization_info, sub_tokens, tokenizer):
+        """lookup wordnet concept ids of the document"""
+        # the document concepts only depend on the passage, which all of its queries share
+        doc_wn_key = (tokenization_info['document_tokens'], tokenization_info['document_sub_to_ori_index'])
+        if self._doc_wn_cache is None or self._doc_wn_cache[0] != doc_wn_key:
+            doc_wn_concepts \
+                = self._lookup_wordnet_concept_ids(sub_tokens,
+                                                   tokenization_info['document_sub_to_ori_index'],
+                                                   tokenization_info['document_tokens'],
+                                                   tolower=not tokenizer.basic_tokenizer.do_lower_case,
+                                                   tokenizer=tokenizer)
+            self._doc_wn_cache = (doc_wn_key, doc_wn_concepts)
+        return self._doc_wn_cache[1]
+
+    def _lookup_query_nell_concepts(self, example, tokenization_info, sub_tokens, tokenizer):
+        """lookup nell concept ids of the query"""
+        return self._lookup_nell_concept_ids(sub_tokens,
+                                             tokenization_info['query_sub_to_ori_index'],
+                                             tokenization_info['query_tokens'],
+                                             self.nell_retrieve_info[example.qas_id]['query_entities'])
+
+    def _lookup_doc_nell_concepts(self, example, tokenization_info, sub_tokens, tokenizer):
+        """lookup nell concept ids of the document"""
+        return self._lookup_nell_concept_ids(sub_tokens,
+                                             tokenization_info['document_sub_to_ori_index'],
+                                             tokenization_info['document_tokens'],
+                                             self.nell_retrieve_info[example.qas_id]['document_entities'])
+
+    @staticmethod
+    def _no_concepts(example, tokenization_info, sub_tokens, tokenizer):
+        """empty concept ids for a disabled concept source"""
+        return np.zeros((len(sub_tokens), 0), dtype=np.int32)
+
+    def _get_word_tokenizer(self, tokenizer):
+        """Return `tokenizer.tokenize` memoized per whitespace token."""
+        # whitespace tokens repeat heavily across ReCoRD passages; do_lower_case
+        # is fixed per tokenizer, so the token alone is the cache key
+        if self._word_tokenizer is None or self._word_tokenizer[0] is not tokenizer:
+            self._word_tokenizer = (tokenizer, functools.lru_cache(maxsize=200000)(tokenizer.tokenize))
+        return self._word_tokenizer[1]
 
     def __call__(self,
                  examples,
@@ -258,235 +371,301 @@ class Examples_To_Features_Converter:
                  max_seq_length,
                  doc_stride,
                  max_query_length,
-                 is_training):
-        """Loads a data file into a list of `InputBatch`s."""
+                 is_training,
+                 num_workers=1):
+        """Loads a data file into a list of `InputBatch`s.
+
+        With `num_workers` > 1 the examples are converted by a pool of forked
+        worker processes; features still come out in example order.
+        """
+        convert_kwargs = dict(tokenizer=tokenizer,
+                              max_seq_length=max_seq_length,
+                              doc_stride=doc_stride,
+                              max_query_length=max_query_length,
+                              is_training=is_training)
+        if num_workers > 1:
+            all_example_features = _convert_examples_in_parallel(self, examples, num_workers, convert_kwargs)
+        else:
+            all_example_features = (self.convert_example(example_index, example, **convert_kwargs)
+                                    for (example_index, example) in enumerate(examples))
 
         unique_id = 1000000000
 
-        for (example_index, example) in enumerate(examples):
-            tokenization_info = self.all_tokenization_info[example.qas_id]
-            query_tokens = tokenizer.tokenize(example.question_text)
-            # check online subword tokenization result is the same as offline result
-            assert query_tokens == tokenization_info['query_subtokens']
-            if self.concept_settings['use_wordnet']:
-                query_wn_concepts \
-                    = self._lookup_wordnet_concept_ids(query_tokens,
-                                                       tokenization_info['query_sub_to_ori_index'],
-                                                       tokenization_info['query_tokens'],
-                                                       tolower=not tokenizer.basic_tokenizer.do_lower_case,
-                                                       tokenizer=tokenizer)
-                # if tolower is True, tokenizer must be given
-
-            if self.concept_settings['use_nell']:
-                query_nell_concepts = self._lookup_nell_concept_ids(query_tokens,
-                                                                    tokenization_info['query_sub_to_ori_index'],
-                                                                    tokenization_info['query_tokens'],
-                                                                    self.nell_retrieve_info[example.qas_id][
-                                                                        'query_entities'])
-
-            if len(query_tokens) > max_query_length:
-                query_tokens = query_tokens[0:max_query_length]
-                query_wn_concepts = query_wn_concepts[0:max_query_length]
-                query_nell_concepts = query_nell_concepts[0:max_query_length]
-
-            tok_to_orig_index = []
-            orig_to_tok_index = []
-            all_doc_tokens = []
-            for (i, token) in enumerate(example.doc_tokens):
-                orig_to_tok_index.append(len(all_doc_tokens))
-                sub_tokens = tokenizer.tokenize(token)
-                for sub_token in sub_tokens:
-                    tok_to_orig_index.append(i)
-                    all_doc_tokens.append(sub_token)
-            assert all_doc_tokens == tokenization_info['document_subtokens']
-            if self.concept_settings['use_wordnet']:
-                doc_wn_concepts \
-                    = self._lookup_wordnet_concept_ids(all_doc_tokens,
-                                                       tokenization_info['document_sub_to_ori_index'],
-                                                       tokenization_info['document_tokens'],
-                                                       tolower=not tokenizer.basic_tokenizer.do_lower_case,
-                                                       tokenizer=tokenizer)
-                # if tolower is True, tokenizer must be given
-
-            if self.concept_settings['use_nell']:
-                doc_nell_concepts = self._lookup_nell_concept_ids(all_doc_tokens,
-                                                                  tokenization_info['document_sub_to_ori_index'],
-                                                                  tokenization_info['document_tokens'],
-                                                                  self.nell_retrieve_info[example.qas_id][
-                                                                      'document_entities'])
-
-            tok_start_position = None
-            tok_end_position = None
-            if is_training and example.is_impossible:
-                tok_start_position = -1
-                tok_end_position = -1
-            if is_training and not example.is_impossible:
-                tok_start_position = orig_to_tok_index[example.start_position]
-                if example.end_position < len(example.doc_tokens) - 1:
-                    tok_end_position = orig_to_tok_index[example.end_position +
-                                                         1] - 1
-                else:
-                    tok_end_position = len(all_doc_tokens) - 1
-                (tok_start_position, tok_end_position) = _improve_answer_span(
-                    all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
-                    example.orig_answer_text)
-
-            # The -3 accounts for [CLS], [SEP] and [SEP]
-            max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
-
-            # We can have documents that are longer than the maximum sequence length.
-            # To deal with this we do a sliding window approach, where we take chunks
-            # of the up to our max length with a stride of `doc_stride`.
-            _DocSpan = collections.namedtuple(  # pylint: disable=invalid-name
-                "DocSpan", ["start", "length"])
-            doc_spans = []
-            start_offset = 0
-            while start_offset < len(all_doc_tokens):
-                length = len(all_doc_tokens) - start_offset
-                if length > max_tokens_for_doc:
-                    length = max_tokens_for_doc
-                doc_spans.append(_DocSpan(start=start_offset, length=length))
-                if start_offset + length == len(all_doc_tokens):
-                    break
-                start_offset += min(length, doc_stride)
-
-            for (doc_span_index, doc_span) in enumerate(doc_spans):
-                tokens = []
-                token_to_orig_map = {}
-                token_is_max_context = {}
-                segment_ids = []
-                wn_concept_ids = []
-                nell_concept_ids = []
-
-                tokens.append("[CLS]")
-                segment_ids.append(0)
-                wn_concept_ids.append([])
-                nell_concept_ids.append([])
-                for token, query_wn_concept, query_nell_concept in zip(query_tokens, query_wn_concepts,
-                                                                       query_nell_concepts):
-                    tokens.append(token)
-                    segment_ids.append(0)
-                    wn_concept_ids.append(query_wn_concept)
-                    nell_concept_ids.append(query_nell_concept)
-                tokens.append("[SEP]")
-                segment_ids.append(0)
-                wn_concept_ids.append([])
-                nell_concept_ids.append([])
-
-                for i in range(doc_span.length):
-                    split_token_index = doc_span.start + i
-                    token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-                    is_max_context = _check_is_max_context(doc_spans, doc_span_index,
-                                                           split_token_index)
-                    token_is_max_context[len(tokens)] = is_max_context
-                    tokens.append(all_doc_tokens[split_token_index])
-                    segment_ids.append(1)
-                    wn_concept_ids.append(doc_wn_concepts[split_token_index])
-                    nell_concept_ids.append(doc_nell_concepts[split_token_index])
-                tokens.append("[SEP]")
-                segment_ids.append(1)
-                wn_concept_ids.append([])
-                nell_concept_ids.append([])
-
-                input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-                # The mask has 1 for real tokens and 0 for padding tokens. Only real
-                # tokens are attended to.
-                input_mask = [1] * len(input_ids)
-
-                # Zero-pad up to the sequence length.
-                # while len(input_ids) < max_seq_length:
-                #  input_ids.append(0)
-                #  input_mask.append(0)
-                #  segment_ids.append(0)
-
-                # assert len(input_ids) == max_seq_length
-                # assert len(input_mask) == max_seq_length
-                # assert len(segment_ids) == max_seq_length
-
-                for concept_ids, max_concept_length in zip((wn_concept_ids, nell_concept_ids),
-                                                           (self.max_wn_concept_length, self.max_nell_concept_length)):
-                    for cindex, concept_id in enumerate(concept_ids):
-                        concept_ids[cindex] = concept_id + [0] * (max_concept_length - len(concept_id))
-                        concept_ids[cindex] = concept_ids[cindex][:max_concept_length]
-                    assert all([len(id_list) == max_concept_length for id_list in concept_ids])
-
-                start_position = None
-                end_position = None
-                if is_training and not example.is_impossible:
-                    # For training, if our document chunk does not contain an annotation
-                    # we throw it out, since there is nothing to predict.
-                    doc_start = doc_span.start
-                    doc_end = doc_span.start + doc_span.length - 1
-                    # out_of_span = False
-                    if not (tok_start_position >= doc_start and
-                            tok_end_position <= doc_end):
-                        continue
-
-                    doc_offset = len(query_tokens) + 2
-                    start_position = tok_start_position - doc_start + doc_offset
-                    end_position = tok_end_position - doc_start + doc_offset
-
-                if is_training and example.is_impossible:
-                    start_position = 0
-                    end_position = 0
-
-                if example_index < 3:
-                    logger.info("*** Example ***")
-                    logger.info("unique_id: %s", unique_id)
-                    logger.info("example_index: %s", example_index)
-                    logger.info("doc_span_index: %s", doc_span_index)
-                    logger.info("tokens: %s", " ".join(
-                        [tokenization.printable_text(x) for x in tokens]))
-                    logger.info("token_to_orig_map: %s", " ".join([
-                        "%d:%d" % (x, y)
-                        for (x, y) in six.iteritems(token_to_orig_map)
-                    ]))
-                    logger.info("token_is_max_context: %s", " ".join([
-                        "%d:%s" % (x, y)
-                        for (x, y) in six.iteritems(token_is_max_context)
-                    ]))
-                    logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
-                    logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
-                    logger.info("segment_ids: %s",
-                                " ".join([str(x) for x in segment_ids]))
-                    logger.info("wordnet_concept_ids: %s", " ".join(
-                        ["{}:{}".format(tidx, list(filter(lambda index: index != 0, x))) for tidx, x in
-                         enumerate(wn_concept_ids)]))
-                    logger.info("nell_concept_ids: %s", " ".join(
-                        ["{}:{}".format(tidx, list(filter(lambda index: index != 0, x))) for tidx, x in
-                         enumerate(nell_concept_ids)]))
-                    if is_training and example.is_impossible:
-                        logger.info("impossible example")
-                    if is_training and not example.is_impossible:
-                        answer_text = " ".join(tokens[start_position:(end_position +
-                                                                      1)])
-                        logger.info("start_position: %d", start_position)
-                        logger.info("end_position: %d", end_position)
-                        logger.info("answer: %s",
-                                    (tokenization.printable_text(answer_text)))
-
-                feature = InputFeatures(
-                    unique_id=unique_id,
-                    example_index=example_index,
-                    doc_span_index=doc_span_index,
-                    tokens=tokens,
-                    token_to_orig_map=token_to_orig_map,
-                    token_is_max_context=token_is_max_context,
-                    input_ids=input_ids,
-                    input_mask=input_mask,
-                    segment_ids=segment_ids,
-                    wn_concept_ids=wn_concept_ids,
-                    nell_concept_ids=nell_concept_ids,
-                    start_position=start_position,
-                    end_position=end_position,
-                    is_impossible=example.is_impossible)
+        for (example_index, example), example_features in zip(enumerate(examples), all_example_features):
+            for feature in example_features:
+                feature.unique_id = unique_id
+                if example_index < 3 and logger.isEnabledFor(logging.INFO):
+                    self._log_feature(feature, example, is_training)
 
                 unique_id += 1
 
                 yield feature
 
+    def convert_example(self,
+                        example_index,
+                        example,
+                        tokenizer,
+                        max_seq_length,
+                        doc_stride,
+                        max_query_length,
+                        is_training):
+        """Converts a single example into its `InputFeatures`, one per doc span."""
+        tokenization_info = self.all_tokenization_info[example.qas_id]
+        query_tokens = tokenizer.tokenize(example.question_text)
+        # check online subword tokenization result is the same as offline result
+        assert query_tokens == tokenization_info['query_subtokens']
+        query_wn_concepts = self._query_wordnet_concepts(example, tokenization_info, query_tokens, tokenizer)
+        query_nell_concepts = self._query_nell_concepts(example, tokenization_info, query_tokens, tokenizer)
+
+        if len(query_tokens) > max_query_length:
+            query_tokens = query_tokens[0:max_query_length]
+            query_wn_concepts = query_wn_concepts[0:max_query_length]
+            query_nell_concepts = query_nell_concepts[0:max_query_length]
+        # the query prefix repeats unchanged in every doc span of this example
+        query_ids = np.asarray(tokenizer.convert_tokens_to_ids(query_tokens), dtype=np.int32)
+
+        # all the queries of a passage share its doc_tokens, so the document
+        # side is only tokenized again when the passage changes
+        if (self._doc_cache is None or self._doc_cache[0] is not example.doc_tokens
+                or self._doc_cache[1] is not tokenizer):
+            tokenize_word = self._get_word_tokenizer(tokenizer)
+            if self.trust_offline_tokenization:
+                all_doc_tokens = tokenization_info['document_subtokens']
+                word_sub_tokens = [tokenize_word(token) for token in example.doc_tokens]
+                # a stale tokenization pickle with other subtokens of the same total
+                # count would silently misalign tok_to_orig_index, so compare them all
+                assert list(itertools.chain.from_iterable(word_sub_tokens)) == all_doc_tokens
+                num_sub_tokens = np.fromiter(map(len, word_sub_tokens), dtype=np.int64,
+                                             count=len(word_sub_tokens))
+                tok_to_orig_index = np.repeat(np.arange(len(num_sub_tokens)), num_sub_tokens)
+                orig_to_tok_index = (np.cumsum(num_sub_tokens) - num_sub_tokens).tolist()
+            else:
+                tok_to_orig_index = []
+                orig_to_tok_index = []
+                all_doc_tokens = []
+                for (i, token) in enumerate(example.doc_tokens):
+                    orig_to_tok_index.append(len(all_doc_tokens))
+                    sub_tokens = tokenize_word(token)
+                    for sub_token in sub_tokens:
+                        tok_to_orig_index.append(i)
+                        all_doc_tokens.append(sub_token)
+            all_doc_ids = np.asarray(tokenizer.convert_tokens_to_ids(all_doc_tokens), dtype=np.int32)
+            tok_to_orig_arr = np.asarray(tok_to_orig_index, dtype=np.int32)
+            self._doc_cache = (example.doc_tokens, tokenizer, tok_to_orig_arr,
+                               orig_to_tok_index, all_doc_tokens, all_doc_ids)
+        (_, _, tok_to_orig_arr, orig_to_tok_index,
+         all_doc_tokens, all_doc_ids) = self._doc_cache
+        if not self.trust_offline_tokenization:
+            assert all_doc_tokens == tokenization_info['document_subtokens']
+        doc_wn_concepts = self._doc_wordnet_concepts(example, tokenization_info, all_doc_tokens, tokenizer)
+        doc_nell_concepts = self._doc_nell_concepts(example, tokenization_info, all_doc_tokens, tokenizer)
+
+        tok_start_position = None
+        tok_end_position = None
+        has_answer = is_training and not example.is_impossible
+        if is_training and example.is_impossible:
+            tok_start_position = -1
+            tok_end_position = -1
+        if has_answer:
+            tok_start_position = orig_to_tok_index[example.start_position]
+            if example.end_position < len(example.doc_tokens) - 1:
+                tok_end_position = orig_to_tok_index[example.end_position +
+                                                     1] - 1
+            else:
+                tok_end_position = len(all_doc_tokens) - 1
+            (tok_start_position, tok_end_position) = _improve_answer_span(
+                all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
+                example.orig_answer_text)
+
+        # The -3 accounts for [CLS], [SEP] and [SEP]
+        max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
+
+        # We can have documents that are longer than the maximum sequence length.
+        # To deal with this we do a sliding window approach, where we take chunks
+        # of the up to our max length with a stride of `doc_stride`.
+        doc_span_starts = []
+        doc_span_lengths = []
+        start_offset = 0
+        while start_offset < len(all_doc_tokens):
+            length = len(all_doc_tokens) - start_offset
+            if length > max_tokens_for_doc:
+                length = max_tokens_for_doc
+            doc_span_starts.append(start_offset)
+            doc_span_lengths.append(length)
+            if start_offset + length == len(all_doc_tokens):
+                break
+            start_offset += min(length, doc_stride)
+
+        max_context_span_indexes = _max_context_span_indexes(
+            np.asarray(doc_span_starts, dtype=np.int32),
+            np.asarray(doc_span_lengths, dtype=np.int32),
+            len(all_doc_tokens))
+
+        cls_ids = np.asarray(tokenizer.convert_tokens_to_ids(["[CLS]"]), dtype=np.int32)
+        sep_ids = np.asarray(tokenizer.convert_tokens_to_ids(["[SEP]"]), dtype=np.int32)
+        for (doc_span_index, (doc_span_start, doc_span_length)) in enumerate(zip(doc_span_starts, doc_span_lengths)):
+            tokens = []
+            segment_ids = []
+
+            tokens.append("[CLS]")
+            segment_ids.append(0)
+            for token in query_tokens:
+                tokens.append(token)
+                segment_ids.append(0)
+            tokens.append("[SEP]")
+            segment_ids.append(0)
+
+            doc_span_end = doc_span_start + doc_span_length
+            tokens.extend(all_doc_tokens[doc_span_start:doc_span_end])
+            segment_ids.extend([1] * doc_span_length)
+            tokens.append("[SEP]")
+            segment_ids.append(1)
+
+            query_start = 1
+            doc_start = query_start + len(query_tokens) + 1
+            doc_end = doc_start + doc_span_length
+            token_to_orig_arr = np.full(len(tokens), -1, dtype=np.int32)
+            token_to_orig_arr[doc_start:doc_end] = tok_to_orig_arr[doc_span_start:doc_span_end]
+            token_is_max_context_arr = np.zeros(len(tokens), dtype=np.bool_)
+            token_is_max_context_arr[doc_start:doc_end] \
+                = max_context_span_indexes[doc_span_start:doc_span_end] == doc_span_index
+
+            # [CLS], [SEP] and [SEP] have no wordnet or nell concepts, so their rows stay zero
+            wn_concept_ids = np.zeros((len(tokens), self.max_wn_concept_length), dtype=np.int32)
+            wn_concept_ids[query_start:doc_start - 1] = query_wn_concepts
+            wn_concept_ids[doc_start:doc_end] = doc_wn_concepts[doc_span_start:(doc_span_start + doc_span_length)]
+            nell_concept_ids = np.zeros((len(tokens), self.max_nell_concept_length), dtype=np.int32)
+            nell_concept_ids[query_start:doc_start - 1] = query_nell_concepts
+            nell_concept_ids[doc_start:doc_end] = doc_nell_concepts[doc_span_start:(doc_span_start + doc_span_length)]
+
+            input_ids = np.concatenate((
+                cls_ids, query_ids, sep_ids,
+                all_doc_ids[doc_span_start:(doc_span_start + doc_span_length)], sep_ids))
+
+            # The mask has 1 for real tokens and 0 for padding tokens. Only real
+            # tokens are attended to.
+            input_mask = np.ones(len(input_ids), dtype=np.int32)
+
+            # Zero-pad up to the sequence length.
+            # while len(input_ids) < max_seq_length:
+            #  input_ids.append(0)
+            #  input_mask.append(0)
+            #  segment_ids.append(0)
+
+            # assert len(input_ids) == max_seq_length
+            # assert len(input_mask) == max_seq_length
+            # assert len(segment_ids) == max_seq_length
+
+            # store the fields as contiguous int32 arrays rather than python lists
+            segment_ids = np.asarray(segment_ids, dtype=np.int32)
+
+            start_position = None
+            end_position = None
+            if has_answer:
+                # For training, if our document chunk does not contain an annotation
+                # we throw it out, since there is nothing to predict.
+                doc_start = doc_span_start
+                doc_end = doc_span_start + doc_span_length - 1
+                # out_of_span = False
+                if not (tok_start_position >= doc_start and
+                        tok_end_position <= doc_end):
+                    continue
+
+                doc_offset = len(query_tokens) + 2
+                start_position = tok_start_position - doc_start + doc_offset
+                end_position = tok_end_position - doc_start + doc_offset
+            elif is_training:
+                start_position = 0
+                end_position = 0
+
+            feature = InputFeatures(
+                unique_id=None,
+                example_index=example_index,
+                doc_span_index=doc_span_index,
+                tokens=tokens,
+                token_to_orig_arr=token_to_orig_arr,
+                token_is_max_context_arr=token_is_max_context_arr,
+                input_ids=input_ids,
+                input_mask=input_mask,
+                segment_ids=segment_ids,
+                wn_concept_ids=wn_concept_ids,
+                nell_concept_ids=nell_concept_ids,
+                start_position=start_position,
+                end_position=end_position,
+                is_impossible=example.is_impossible)
+
+            yield feature
+
+    @staticmethod
+    def _log_feature(feature, example, is_training):
+        """Log the content of a feature for inspection."""
+        logger.info("*** Example ***")
+        logger.info("unique_id: %s", feature.unique_id)
+        logger.info("example_index: %s", feature.example_index)
+        logger.info("doc_span_index: %s", feature.doc_span_index)
+        logger.info("tokens: %s", _LazyJoin(feature.tokens))
+        doc_positions = np.flatnonzero(feature.token_to_orig_arr >= 0).tolist()
+        logger.info("token_to_orig_map: %s", _LazyJoin(
+            [(i, int(feature.token_to_orig_arr[i])) for i in doc_positions], "%d:%d".__mod__))
+        logger.info("token_is_max_context: %s", _LazyJoin(
+            [(i, bool(feature.token_is_max_context_arr[i])) for i in doc_positions], "%d:%s".__mod__))
+        logger.info("input_ids: %s", _LazyJoin(feature.input_ids))
+        logger.info("input_mask: %s", _LazyJoin(feature.input_mask))
+        logger.info("segment_ids: %s", _LazyJoin(feature.segment_ids))
+        logger.info("wordnet_concept_ids: %s",
+                    _LazyJoin(list(enumerate(feature.wn_concept_ids)), _format_concept_row))
+        logger.info("nell_concept_ids: %s",
+                    _LazyJoin(list(enumerate(feature.nell_concept_ids)), _format_concept_row))
+        if is_training and example.is_impossible:
+            logger.info("impossible example")
+        if is_training and not example.is_impossible:
+            logger.info("start_position: %d", feature.start_position)
+            logger.info("end_position: %d", feature.end_position)
+            logger.info("answer: %s", _LazyJoin(feature.tokens[feature.start_position:(feature.end_position + 1)]))
+
+
+class _LazyJoin:
+    """Space-joins formatted items only when the log record holding it is emitted."""
+
+    def __init__(self, items, format_item=str):
+        self.items = items
+        self.format_item = format_item
+
+    def __str__(self):
+        return " ".join(map(self.format_item, self.items))
+
+
+def _format_concept_row(indexed_row):
+    """Formats a (token index, padded concept ids) pair without the padding ids."""
+    tidx, row = indexed_row
+    return "{}:{}".format(tidx, row[row != 0].tolist())
+
+
+_WORKER_STATE = {}
+
+
+def _init_features_worker(converter, convert_kwargs):
+    _WORKER_STATE['converter'] = converter
+    _WORKER_STATE['convert_kwargs'] = convert_kwargs
+
+
+def _convert_example_in_worker(indexed_example):
+    example_index, example = indexed_example
+    return list(_WORKER_STATE['converter'].convert_example(
+        example_index, example, **_WORKER_STATE['convert_kwargs']))
+
+
+def _convert_examples_in_parallel(converter, examples, num_workers, convert_kwargs):
+    """Convert examples in worker processes, yielding the features of each example in order."""
+    # forked workers inherit the loaded tokenization and concept data instead of
+    # unpickling it; examples are sent in chunks so that queries of the same
+    # passage keep sharing their doc_tokens inside a worker
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_workers, initializer=_init_features_worker,
+                      initargs=(converter, convert_kwargs)) as pool:
+        for example_features in pool.imap(_convert_example_in_worker, enumerate(examples), chunksize=32):
+            yield example_features
+
 
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
@@ -514,19 +693,24 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
     # the word "Japanese". Since our WordPiece tokenizer does not split
     # "Japanese", we just use "Japanese" as the annotation. This is fairly rare
     # in ReCoRD, but does happen.
-    tok_answer_text = " ".join(tokenizer.tokenize(orig_answer_text))
-
-    for new_start in range(input_start, input_end + 1):
-        for new_end in range(input_end, new_start - 1, -1):
-            text_span = " ".join(doc_tokens[new_start:(new_end + 1)])
-            if text_span == tok_answer_text:
-                return new_start, new_end
+    #
+    # WordPiece tokens never contain spaces, so comparing space-joined spans is
+    # the same as comparing token lists, and only spans as long as the answer
+    # can match. This turns the search into a single sliding window.
+    tok_answer_tokens = tokenizer.tokenize(orig_answer_text)
+    answer_length = len(tok_answer_tokens)
+    if answer_length == 0:
+        return input_start, input_end
+
+    for new_start in range(input_start, input_end - answer_length + 2):
+        if doc_tokens[new_start:(new_start + answer_length)] == tok_answer_tokens:
+            return new_start, new_start + answer_length - 1
 
     return input_start, input_end
 
 
-def _check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token."""
+def _max_context_span_indexes(span_starts, span_lengths, num_tokens):
+    """Return the index of the 'max context' doc span of every document token."""
 
     # Because of the sliding window approach taken to scoring documents, a single
     # token can appear in multiple documents. E.g.
@@ -544,35 +728,116 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     # In the example the maximum context for 'bought' would be span C since
     # it has 1 left context and 3 right context, while span B has 4 left context
     # and 0 right context.
-    best_score = None
-    best_span_index = None
-    for (span_index, doc_span) in enumerate(doc_spans):
-        end = doc_span.start + doc_span.length - 1
-        if position < doc_span.start:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span.start
-        num_right_context = end - position
-        score = min(num_left_context,
-                    num_right_context) + 0.01 * doc_span.length
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
-
-    return cur_span_index == best_span_index
+    #
+    # Scores of all (span, token) pairs are computed at once; tokens outside a
+    # span score -inf for it, and argmax keeps the first span on ties.
+    if not span_starts.size:
+        return np.zeros(num_tokens, dtype=np.int64)
+    positions = np.arange(num_tokens)[np.newaxis, :]
+    starts = span_starts[:, np.newaxis]
+    ends = starts + span_lengths[:, np.newaxis] - 1
+    scores = np.minimum(positions - starts, ends - positions) + 0.01 * span_lengths[:, np.newaxis]
+    scores = np.where((positions >= starts) & (positions <= ends), scores, -np.inf)
+    return np.argmax(scores, axis=0)
+
+
+# bumped whenever the cached InputFeatures or the cache file layout change
+_FEATURES_CACHE_VERSION = 4
+
+_CACHE_TRAILER = struct.Struct('<Q')
+
+
+def _load_cached_features(cache_path, examples):
+    """Yield the cached features of `examples`, in the order of `examples`.
+
+    The cache holds the features of each example under its qas_id, so it can be
+    replayed in any order; example_index and unique_id are assigned again the
+    same way the converter assigns them.
+    """
+    with open(cache_path, 'rb') as reader:
+        reader.seek(-_CACHE_TRAILER.size, os.SEEK_END)
+        (index_offset,) = _CACHE_TRAILER.unpack(reader.read(_CACHE_TRAILER.size))
+        reader.seek(index_offset)
+        feature_offsets = pickle.load(reader)
+
+        unique_id = 1000000000
+        for (example_index, example) in enumerate(examples):
+            offset = feature_offsets.get(example.qas_id)
+            if offset is None:  # no doc span of this example holds its answer
+                continue
+            reader.seek(offset)
+            for feature in pickle.load(reader):
+                feature.example_index = example_index
+                feature.unique_id = unique_id
+                unique_id += 1
+                yield feature
+
+
+def _cache_features(features, examples, cache_path):
+    """Pass `features` through while pickling them into `cache_path`.
+
+    The features of each example are pickled as one list, followed by an index
+    from qas_id to the offset of that list. The cache file only appears once
+    the whole stream has been written, so a partially consumed generator never
+    leaves a truncated cache behind.
+    """
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as writer:
+            feature_offsets = {}
+            for example_index, example_features in itertools.groupby(features, lambda f: f.example_index):
+                example_features = list(example_features)
+                feature_offsets[examples[example_index].qas_id] = writer.tell()
+                pickle.dump(example_features, writer, protocol=pickle.HIGHEST_PROTOCOL)
+                yield from example_features
+            index_offset = writer.tell()
+            pickle.dump(feature_offsets, writer, protocol=pickle.HIGHEST_PROTOCOL)
+            writer.write(_CACHE_TRAILER.pack(index_offset))
+        os.replace(tmp_path, cache_path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _same_concept_settings(settings, other_settings):
+    """Compares concept settings, matching the large concept2id dicts by identity."""
+    if settings.keys() != other_settings.keys():
+        return False
+    for name, value in settings.items():
+        other_value = other_settings[name]
+        if value is not other_value and (isinstance(value, dict) or value != other_value):
+            return False
+    return True
 
 
 class DataProcessor:
     """process data"""
     def __init__(self, vocab_path, do_lower_case, max_seq_length, in_tokens,
-                 doc_stride, max_query_length):
+                 doc_stride, max_query_length, cache_dir=None, num_workers=1,
+                 trust_offline_tokenization=True):
         self._tokenizer = tokenization.FullTokenizer(
             vocab_file=vocab_path, do_lower_case=do_lower_case)
+        self._vocab_path = vocab_path
+        self._do_lower_case = do_lower_case
         self._max_seq_length = max_seq_length
         self._doc_stride = doc_stride
         self._max_query_length = max_query_length
         self._in_tokens = in_tokens
+        # directory for caching converted features across epochs and runs, disabled if None
+        self._cache_dir = cache_dir
+        # number of processes converting examples to features
+        self._num_workers = num_workers
+        # check the offline document subtokens once per passage instead of once per query
+        self._trust_offline_tokenization = trust_offline_tokenization
+        # the converter of the last concept settings, and the last converted predict
+        # features, which the eval scripts convert a second time for write_predictions
+        self._converter = None
+        self._converter_settings = None
+        self._predict_features = None
+        # content digests of the concept2id dicts hashed into the cache key, by dict identity
+        self._concept2id_digests = {}
 
         self.vocab = self._tokenizer.vocab
         self.vocab_size = len(self.vocab)
@@ -602,10 +867,10 @@ class DataProcessor:
                      data_path,
                      is_training,
                      version_2_with_negative=False):
-        examples = read_record_examples(
+        examples = list(read_record_examples(
             input_file=data_path,
             is_training=is_training,
-            version_2_with_negative=version_2_with_negative)
+            version_2_with_negative=version_2_with_negative))
         return examples
 
     def get_num_examples(self, phase):
@@ -615,16 +880,87 @@ class DataProcessor:
         return self.num_examples[phase]
 
     def get_features(self, examples, is_training, **concept_settings):
-        convert_examples_to_features = Examples_To_Features_Converter(**concept_settings)
+        """Convert examples to features, replaying them from the feature cache if possible."""
+        if not is_training and self._predict_features is not None:
+            cached_examples, cached_settings, cached_features = self._predict_features
+            if (len(cached_examples) == len(examples) and _same_concept_settings(cached_settings, concept_settings)
+                    and all(a is b for a, b in zip(cached_examples, examples))):
+                return cached_features
+
+        cache_path = None
+        if self._cache_dir is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            cache_key = self._features_cache_key(examples, is_training, concept_settings)
+            cache_path = os.path.join(self._cache_dir, 'record_features.%s.pkl' % cache_key)
+            if os.path.exists(cache_path):
+                logger.info("Loading cached features from %s", cache_path)
+                return _load_cached_features(cache_path, examples)
+
+        convert_examples_to_features = self._get_converter(concept_settings)
         features = convert_examples_to_features(
             examples=examples,
             tokenizer=self._tokenizer,
             max_seq_length=self._max_seq_length,
             doc_stride=self._doc_stride,
             max_query_length=self._max_query_length,
-            is_training=is_training)
+            is_training=is_training,
+            num_workers=self._num_workers)
+        if cache_path is not None:
+            features = _cache_features(features, examples, cache_path)
+        if not is_training:
+            # predict features are few enough to keep; training features are
+            # streamed, since their dense concept id arrays would not fit in memory
+            features = list(features)
+            self._predict_features = (list(examples), dict(concept_settings), features)
         return features
 
+    def _get_converter(self, concept_settings):
+        """Returns the converter for the concept settings, building it only when they change."""
+        if self._converter is None or not _same_concept_settings(self._converter_settings, concept_settings):
+            self._converter = Examples_To_Features_Converter(
+                trust_offline_tokenization=self._trust_offline_tokenization, **concept_settings)
+            self._converter_settings = dict(concept_settings)
+        return self._converter
+
+    def _features_cache_key(self, examples, is_training, concept_settings):
+        """Hash everything the converted features depend on, except the order of the examples."""
+        settings = []
+        for name, value in sorted(concept_settings.items()):
+            if isinstance(value, dict):
+                value = self._concept2id_digest(value)
+            elif isinstance(value, str) and os.path.exists(value):
+                value = (value, os.path.getmtime(value))
+            settings.append((name, value))
+        hasher = hashlib.sha1(repr((
+            _FEATURES_CACHE_VERSION, self._vocab_path, os.path.getmtime(self._vocab_path), self._do_lower_case,
+            self._max_seq_length, self._doc_stride, self._max_query_length,
+            self._trust_offline_tokenization, is_training, settings)).encode('utf-8'))
+
+        # the queries of a passage share its doc_tokens, which are hashed once
+        doc_digests = {}
+        example_digests = []
+        for example in examples:
+            doc_digest = doc_digests.get(id(example.doc_tokens))
+            if doc_digest is None:
+                doc_digest = hashlib.sha1(
+                    " ".join(example.doc_tokens).encode('utf-8', 'surrogatepass')).hexdigest()
+                doc_digests[id(example.doc_tokens)] = doc_digest
+            example_digests.append(repr((example.qas_id, example.question_text, example.orig_answer_text,
+                                         example.start_position, example.end_position,
+                                         example.is_impossible, doc_digest)))
+        for example_digest in sorted(example_digests):
+            hasher.update(example_digest.encode('utf-8', 'surrogatepass'))
+        return hasher.hexdigest()
+
+    def _concept2id_digest(self, concept2id):
+        """Hash the contents of a concept2id dict, once per dict object."""
+        cached = self._concept2id_digests.get(id(concept2id))
+        if cached is None or cached[0] is not concept2id:
+            digest = hashlib.sha1(repr(sorted(concept2id.items())).encode('utf-8', 'surrogatepass')).hexdigest()
+            cached = (concept2id, digest)
+            self._concept2id_digests[id(concept2id)] = cached
+        return cached[1]
+
     def data_generator(self,
                        data_path,
                        batch_size,
@@ -654,41 +990,43 @@ class DataProcessor:
                 "Unknown phase, which should be in ['train', 'predict'].")
 
         def batch_reader(features, batch_size, in_tokens):
-            batch, total_token_num, max_len = [], 0, 0
+            batch, batch_len, total_token_num, max_len = new_batch(), 0, 0, 0
             for (index, feature) in enumerate(features):
                 if phase == 'train':
                     self.current_train_example = index + 1
                 seq_len = len(feature.input_ids)
-                labels = [feature.unique_id] if feature.start_position is None else [feature.start_position,
-                                                                                     feature.end_position]
-                example = [feature.input_ids, feature.segment_ids, range(384), feature.wn_concept_ids,
-                           feature.nell_concept_ids] + labels
+                labels = (feature.unique_id,) if feature.start_position is None else (feature.start_position,
+                                                                                      feature.end_position)
                 max_len = max(max_len, seq_len)
 
                 # max_len = max(max_len, len(token_ids))
                 if in_tokens:
-                    to_append = (len(batch) + 1) * max_len <= batch_size
+                    to_append = (batch_len + 1) * max_len <= batch_size
                 else:
-                    to_append = len(batch) < batch_size
+                    to_append = batch_len < batch_size
 
-                if to_append:
-                    batch.append(example)
-                    total_token_num += seq_len
-                else:
+                if not to_append:
                     yield batch, total_token_num
-                    batch, total_token_num, max_len = [example], seq_len, seq_len
-            if batch:
+                    batch, batch_len, total_token_num, max_len = new_batch(), 0, 0, seq_len
+                add_to_batch(batch, feature.input_ids, feature.segment_ids, _POSITION_IDS, feature.wn_concept_ids,
+                             feature.nell_concept_ids, labels)
+                batch_len += 1
+                total_token_num += seq_len
+            if batch_len:
                 yield batch, total_token_num
 
+        converter = self._get_converter(concept_settings)
         if phase == 'train':
-            self.train_wn_max_concept_length = Examples_To_Features_Converter(**concept_settings).max_wn_concept_length
-            self.train_nell_max_concept_length = Examples_To_Features_Converter(
-                **concept_settings).max_nell_concept_length
+            self.train_wn_max_concept_length = converter.max_wn_concept_length
+            self.train_nell_max_concept_length = converter.max_nell_concept_length
         else:
-            self.predict_wn_max_concept_length = Examples_To_Features_Converter(
-                **concept_settings).max_wn_concept_length
-            self.predict_nell_max_concept_length = Examples_To_Features_Converter(
-                **concept_settings).max_nell_concept_length
+            self.predict_wn_max_concept_length = converter.max_wn_concept_length
+            self.predict_nell_max_concept_length = converter.max_nell_concept_length
+
+        if phase == 'train' and epoch > 1 and self._cache_dir is None:
+            # training features are too large to keep in memory across epochs
+            logger.info("Training features are converted again in each of the %d epochs, "
+                        "set cache_dir to convert them once", epoch)
 
         def wrapper():
             for epoch_index in range(epoch):
@@ -728,232 +1066,394 @@ class DataProcessor:
         return wrapper
 
 
+def _index_results_by_unique_id(all_results):
+    """
+    Returns the results in a container indexed by `unique_id - offset`, and the offset.
+    The converter assigns unique ids sequentially, so they normally fill a dense
+    range and index a list directly; otherwise this falls back to a dict.
+    """
+    unique_id_to_result = {}
+    for result in all_results:
+        unique_id_to_result[result.unique_id] = result
+    if not unique_id_to_result:
+        return unique_id_to_result, 0
+    min_unique_id = min(unique_id_to_result)
+    num_slots = max(unique_id_to_result) - min_unique_id + 1
+    if num_slots > 2 * len(unique_id_to_result):
+        return unique_id_to_result, 0
+    results = [None] * num_slots
+    for unique_id, result in unique_id_to_result.items():
+        results[unique_id - min_unique_id] = result
+    return results, min_unique_id
+
+
+class _PrelimPrediction:
+    """A candidate answer span of a feature, with its summed score."""
+    __slots__ = ("feature_index", "start_index", "end_index", "start_logit", "end_logit", "score")
+
+    def __init__(self, feature_index, start_index, end_index, start_logit, end_logit):
+        self.feature_index = feature_index
+        self.start_index = start_index
+        self.end_index = end_index
+        self.start_logit = start_logit
+        self.end_logit = end_logit
+        self.score = start_logit + end_logit
+
+
+class _NbestPrediction:
+    """A deduplicated n-best answer text of an example."""
+    __slots__ = ("text", "start_logit", "end_logit")
+
+    def __init__(self, text, start_logit, end_logit):
+        self.text = text
+        self.start_logit = start_logit
+        self.end_logit = end_logit
+
+
 def write_predictions(all_examples, all_features, all_results, n_best_size,
                       max_answer_length, do_lower_case, output_prediction_file,
                       output_nbest_file, output_null_log_odds_file,
                       version_2_with_negative, null_score_diff_threshold,
-                      verbose, predict_file, evaluation_result_file):
-    """Write final predictions to the json file and log-odds of null if needed."""
+                      verbose, predict_file, evaluation_result_file, num_workers=1):
+    """
+    Write final predictions to the json file and log-odds of null if needed.
+    With `num_workers` > 1 the examples are predicted in forked worker processes.
+    """
     logger.info("Writing predictions to: %s", output_prediction_file)
     logger.info("Writing nbest to: %s", output_nbest_file)
     logger.info("Writing evaluation result to: %s", evaluation_result_file)
 
     # load ground truth file for evaluation and post-edit
-    with open(predict_file, "r", encoding='utf-8') as reader:
-        predict_json = json.load(reader)["data"]
-        all_candidates = {}
+    with open(predict_file, "rb") as reader:
+        predict_json = json_loads(reader.read())["data"]
+        # a prediction has a positive f1 score against some candidate entity exactly
+        # when they share a normalized token, so each passage keeps the union of
+        # the normalized tokens of its candidates
+        all_candidate_tokens = {}
         for passage in predict_json:
             passage_text = passage['passage']['text']
-            candidates = []
+            candidate_tokens = set()
             for entity_info in passage['passage']['entities']:
                 start_offset = entity_info['start']
                 end_offset = entity_info['end']
-                candidates.append(passage_text[start_offset: end_offset + 1])
+                candidate_tokens.update(normalize_answer(passage_text[start_offset: end_offset + 1]).split())
             for qa in passage['qas']:
-                all_candidates[qa['id']] = candidates
+                all_candidate_tokens[qa['id']] = candidate_tokens
+
+    # order the features by example (stably, they normally already are), so that the
+    # features of every example are one contiguous slice
+    all_features = list(all_features)
+    feature_example_indexes = np.array([feature.example_index for feature in all_features], dtype=np.int64)
+    if np.any(feature_example_indexes[1:] < feature_example_indexes[:-1]):
+        feature_order = np.argsort(feature_example_indexes, kind='stable')
+        all_features = [all_features[index] for index in feature_order.tolist()]
+        feature_example_indexes = feature_example_indexes[feature_order]
+    example_feature_starts = np.searchsorted(feature_example_indexes, np.arange(len(all_examples) + 1)).tolist()
+
+    results_by_unique_id, min_unique_id = _index_results_by_unique_id(all_results)
+
+    state = {
+        'all_examples': all_examples,
+        'all_features': all_features,
+        'example_feature_starts': example_feature_starts,
+        'results_by_unique_id': results_by_unique_id,
+        'min_unique_id': min_unique_id,
+        'all_candidate_tokens': all_candidate_tokens,
+        'n_best_size': n_best_size,
+        'max_answer_length': max_answer_length,
+        'do_lower_case': do_lower_case,
+        'version_2_with_negative': version_2_with_negative,
+        'null_score_diff_threshold': null_score_diff_threshold,
+        'verbose': verbose,
+    }
+    if num_workers > 1:
+        example_predictions = _predict_examples_in_parallel(state, len(all_examples), num_workers)
+    else:
+        example_predictions = (_predict_example(state, example_index)
+                               for example_index in range(len(all_examples)))
+
+    all_predictions = {}
+    all_nbest_json = {}
+    scores_diff_json = {}
+    for (qas_id, prediction, nbest_json, score_diff) in example_predictions:
+        all_predictions[qas_id] = prediction
+        all_nbest_json[qas_id] = nbest_json
+        if version_2_with_negative:
+            scores_diff_json[qas_id] = score_diff
 
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
+    with open(output_prediction_file, "w") as writer:
+        json.dump(all_predictions, writer, indent=4)
+        writer.write("\n")
 
-    unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
+    with open(output_nbest_file, "w") as writer:
+        json.dump(all_nbest_json, writer, indent=4)
+        writer.write("\n")
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", [
-            "feature_index", "start_index", "end_index", "start_logit",
-            "end_logit"
-        ])
-
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
-
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min mull score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[
-                    0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
+    if version_2_with_negative:
+        with open(output_null_log_odds_file, "w") as writer:
+            json.dump(scores_diff_json, writer, indent=4)
+            writer.write("\n")
 
-        if version_2_with_negative:
+    eval_result, _ = evaluate(predict_json, all_predictions)
+
+    with open(evaluation_result_file, "w") as writer:
+        json.dump(eval_result, writer, indent=4)
+        writer.write("\n")
+
+    return eval_result
+
+
+def _strip_spaces(text):
+    """Removes the spaces of `text`, with the array of original indexes of the kept characters."""
+    # one 4-byte unit per character, so unit indexes are character indexes
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    ns_to_s_map = np.flatnonzero(codes != ord(" "))
+    return text.replace(" ", ""), ns_to_s_map
+
+
+def _project_position(position, tok_s_to_ns_map, orig_ns_to_s_map):
+    """Maps a character index of the tokenized text to `orig_text`, or None if it has no counterpart."""
+    if 0 <= position < len(tok_s_to_ns_map):
+        ns_position = tok_s_to_ns_map[position]
+        if 0 <= ns_position < len(orig_ns_to_s_map):
+            return int(orig_ns_to_s_map[ns_position])
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_basic_tokenizer(do_lower_case):
+    """One shared basic tokenizer per casing."""
+    return tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+
+
+@functools.lru_cache(maxsize=4096)
+def _align_orig_text(orig_text, do_lower_case):
+    """
+    Tokenizes `orig_text` and strips the spaces of both texts. The n-best spans of
+    an example overlap heavily, so the same `orig_text` comes up many times.
+    The returned maps are shared between calls and must not be modified.
+    """
+    tok_text = " ".join(_get_basic_tokenizer(do_lower_case).tokenize(orig_text))
+    (orig_ns_text, orig_ns_to_s_map) = _strip_spaces(orig_text)
+    (tok_ns_text, tok_ns_to_s_map) = _strip_spaces(tok_text)
+    # -1 marks the spaces, which have no stripped index
+    tok_s_to_ns_map = np.full(len(tok_text), -1, dtype=np.int64)
+    tok_s_to_ns_map[tok_ns_to_s_map] = np.arange(len(tok_ns_to_s_map))
+    return tok_text, orig_ns_text, orig_ns_to_s_map, tok_ns_text, tok_s_to_ns_map
+
+
+def _predict_example(state, example_index):
+    """
+    Picks the prediction and n-best answers of one example. `state` holds the inputs
+    shared by all examples, prepared by `write_predictions`.
+    Returns (qas_id, prediction, n-best json, score diff or None).
+    """
+    example = state['all_examples'][example_index]
+    example_feature_starts = state['example_feature_starts']
+    features = state['all_features'][example_feature_starts[example_index]:example_feature_starts[example_index + 1]]
+    results_by_unique_id = state['results_by_unique_id']
+    min_unique_id = state['min_unique_id']
+    n_best_size = state['n_best_size']
+    max_answer_length = state['max_answer_length']
+    do_lower_case = state['do_lower_case']
+    version_2_with_negative = state['version_2_with_negative']
+    null_score_diff_threshold = state['null_score_diff_threshold']
+    verbose = state['verbose']
+
+    prelim_predictions = []
+    # keep track of the minimum score of null start+end of position 0
+    score_null = 1000000  # large and positive
+    min_null_feature_index = 0  # the paragraph slice with min mull score
+    null_start_logit = 0  # the start logit at the slice with min null score
+    null_end_logit = 0  # the end logit at the slice with min null score
+    results = [results_by_unique_id[feature.unique_id - min_unique_id] for feature in features]
+    for (feature, result) in zip(features, results):
+        # out-of-range ids of the list would otherwise silently hit another result
+        if result is None or result.unique_id != feature.unique_id:
+            raise KeyError(feature.unique_id)
+    # (num features, seq len) logits of the example, to be scored all at once
+    all_start_logits = _stack_logits([result.start_logits for result in results])
+    all_end_logits = _stack_logits([result.end_logits for result in results])
+    # if we could have irrelevant answers, get the min score of irrelevant
+    if version_2_with_negative and features:
+        feature_null_scores = all_start_logits[:, 0] + all_end_logits[:, 0]
+        feature_index = int(np.argmin(feature_null_scores))
+        if feature_null_scores[feature_index] < score_null:
+            score_null = float(feature_null_scores[feature_index])
+            min_null_feature_index = feature_index
+            null_start_logit = results[feature_index].start_logits[0]
+            null_end_logit = results[feature_index].end_logits[0]
+    # the -inf padding of shorter rows sorts last and lies past every feature's tokens
+    all_start_indexes = [_get_best_indexes(logits, n_best_size) for logits in all_start_logits]
+    all_end_indexes = [_get_best_indexes(logits, n_best_size) for logits in all_end_logits]
+    for (feature_index, feature) in enumerate(features):
+        result = results[feature_index]
+        # We could hypothetically create invalid predictions, e.g., predict
+        # that the start of the span is in the question. We throw out all
+        # invalid predictions: ends must map to the document, and starts
+        # must also be in the span where the token has its max context.
+        num_tokens = len(feature.token_to_orig_arr)
+        valid_end = np.zeros(all_start_logits.shape[1], dtype=bool)
+        valid_end[:num_tokens] = feature.token_to_orig_arr >= 0
+        valid_start = np.zeros_like(valid_end)
+        valid_start[:num_tokens] = feature.token_is_max_context_arr
+        valid_start &= valid_end
+        start_indexes = np.asarray(all_start_indexes[feature_index], dtype=np.int64)
+        start_indexes = start_indexes[valid_start[start_indexes]]
+        end_indexes = np.asarray(all_end_indexes[feature_index], dtype=np.int64)
+        end_indexes = end_indexes[valid_end[end_indexes]]
+        # keep the (start, end) pairs of a non-empty span of at most max_answer_length
+        lengths = end_indexes[np.newaxis, :] - start_indexes[:, np.newaxis] + 1
+        valid_pairs = np.nonzero((lengths >= 1) & (lengths <= max_answer_length))
+        for (start_index, end_index) in zip(start_indexes[valid_pairs[0]].tolist(),
+                                            end_indexes[valid_pairs[1]].tolist()):
             prelim_predictions.append(
                 _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit))
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"])
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1
-                                                              )]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end +
-                                                                 1)]
-                tok_text = " ".join(tok_tokens)
-
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case,
-                                            verbose)
-                if final_text in seen_predictions:
-                    continue
+                    feature_index=feature_index,
+                    start_index=start_index,
+                    end_index=end_index,
+                    start_logit=result.start_logits[start_index],
+                    end_logit=result.end_logits[end_index]))
 
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
+    if version_2_with_negative:
+        prelim_predictions.append(
+            _PrelimPrediction(
+                feature_index=min_null_feature_index,
+                start_index=0,
+                end_index=0,
+                start_logit=null_start_logit,
+                end_logit=null_end_logit))
+    # only as many predictions as needed to fill the n-best are popped in order of
+    # score; the index breaks ties, like the stable sort of all of them used to
+    prelim_order = [(-pred.score, index) for (index, pred) in enumerate(prelim_predictions)]
+    heapq.heapify(prelim_order)
+
+    seen_predictions = {}
+    seen_spans = set()
+    nbest = []
+    while prelim_order:
+        if len(nbest) >= n_best_size:
+            break
+        pred = prelim_predictions[heapq.heappop(prelim_order)[1]]
+        feature = features[pred.feature_index]
+        if pred.start_index > 0:  # this is a non-null prediction
+            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1
+                                                          )]
+            orig_doc_start = int(feature.token_to_orig_arr[pred.start_index])
+            orig_doc_end = int(feature.token_to_orig_arr[pred.end_index])
+            # the final text only depends on these, so a span seen before (e.g. from
+            # an overlapping doc span) is a duplicate without calling get_final_text
+            span_key = (orig_doc_start, orig_doc_end, tuple(tok_tokens))
+            if span_key in seen_spans:
+                continue
+            seen_spans.add(span_key)
+            orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end +
+                                                             1)]
+            tok_text = " ".join(tok_tokens)
+
+            # De-tokenize WordPieces that have been split off.
+            tok_text = tok_text.replace(" ##", "")
+            tok_text = tok_text.replace("##", "")
+
+            # Clean whitespace, split() also drops the leading and trailing runs
+            tok_text = " ".join(tok_text.split())
+            orig_text = " ".join(orig_tokens)
+
+            final_text = get_final_text(tok_text, orig_text, do_lower_case,
+                                        verbose)
+            if final_text in seen_predictions:
+                continue
 
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit))
+            seen_predictions[final_text] = True
+        else:
+            final_text = ""
+            seen_predictions[final_text] = True
 
-        # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
-            if "" not in seen_predictions:
-                nbest.append(
-                    _NbestPrediction(
-                        text="",
-                        start_logit=null_start_logit,
-                        end_logit=null_end_logit))
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
+        nbest.append(
+            _NbestPrediction(
+                text=final_text,
+                start_logit=pred.start_logit,
+                end_logit=pred.end_logit))
+
+    # if we didn't include the empty option in the n-best, include it
+    if version_2_with_negative:
+        if "" not in seen_predictions:
             nbest.append(
                 _NbestPrediction(
-                    text="empty", start_logit=0.0, end_logit=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
-        # debug
-        if best_non_null_entry is None:
-            logger.info("Emmm..., sth wrong")
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-
-        if not version_2_with_negative:
-            # restrict the finally picked prediction to have overlap with at least one candidate
-            picked_index = 0
-            for pred_index in range(len(nbest_json)):
-                if any([f1_score(nbest_json[pred_index]['text'], candidate) > 0. for candidate in
-                        all_candidates[example.qas_id]]):
-                    picked_index = pred_index
-                    break
-            all_predictions[example.qas_id] = nbest_json[picked_index]["text"]
+                    text="",
+                    start_logit=null_start_logit,
+                    end_logit=null_end_logit))
+    # In very rare edge cases we could have no valid predictions. So we
+    # just create a nonce prediction in this case to avoid failure.
+    if not nbest:
+        nbest.append(
+            _NbestPrediction(
+                text="empty", start_logit=0.0, end_logit=0.0))
+
+    assert len(nbest) >= 1
+
+    total_scores = []
+    best_non_null_entry = None
+    for entry in nbest:
+        total_scores.append(entry.start_logit + entry.end_logit)
+        if not best_non_null_entry:
+            if entry.text:
+                best_non_null_entry = entry
+    # debug
+    if best_non_null_entry is None:
+        logger.info("Emmm..., sth wrong")
+
+    probs = _compute_softmax(total_scores)
+
+    nbest_json = []
+    for (i, entry) in enumerate(nbest):
+        output = {}
+        output["text"] = entry.text
+        output["probability"] = probs[i]
+        output["start_logit"] = entry.start_logit
+        output["end_logit"] = entry.end_logit
+        nbest_json.append(output)
+
+    assert len(nbest_json) >= 1
+
+    score_diff = None
+    if not version_2_with_negative:
+        # restrict the finally picked prediction to have overlap with at least one candidate
+        picked_index = 0
+        candidate_tokens = state['all_candidate_tokens'][example.qas_id]
+        for pred_index in range(len(nbest_json)):
+            if not candidate_tokens.isdisjoint(normalize_answer(nbest_json[pred_index]['text']).split()):
+                picked_index = pred_index
+                break
+        prediction = nbest_json[picked_index]["text"]
+    else:
+        # predict "" iff the null score - the score of best non-null > threshold
+        score_diff = score_null - best_non_null_entry.start_logit - (
+            best_non_null_entry.end_logit)
+        if score_diff > null_score_diff_threshold:
+            prediction = ""
         else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (
-                best_non_null_entry.end_logit)
-            scores_diff_json[example.qas_id] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example.qas_id] = ""
-            else:
-                all_predictions[example.qas_id] = best_non_null_entry.text
+            prediction = best_non_null_entry.text
 
-        all_nbest_json[example.qas_id] = nbest_json
+    return example.qas_id, prediction, nbest_json, score_diff
 
-    with open(output_prediction_file, "w") as writer:
-        writer.write(json.dumps(all_predictions, indent=4) + "\n")
 
-    with open(output_nbest_file, "w") as writer:
-        writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+def _init_predictions_worker(state):
+    _WORKER_STATE['predict_state'] = state
 
-    if version_2_with_negative:
-        with open(output_null_log_odds_file, "w") as writer:
-            writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
-    eval_result, _ = evaluate(predict_json, all_predictions)
+def _predict_example_in_worker(example_index):
+    return _predict_example(_WORKER_STATE['predict_state'], example_index)
 
-    with open(evaluation_result_file, "w") as writer:
-        writer.write(json.dumps(eval_result, indent=4) + "\n")
 
-    return eval_result
+def _predict_examples_in_parallel(state, num_examples, num_workers):
+    """Predict examples in worker processes, yielding their predictions in order."""
+    # forked workers inherit the features and results instead of unpickling them,
+    # only the example indexes and the predictions cross process boundaries
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_workers, initializer=_init_predictions_worker, initargs=(state,)) as pool:
+        for example_prediction in pool.imap(_predict_example_in_worker, range(num_examples), chunksize=64):
+            yield example_prediction
 
 
 def get_final_text(pred_text, orig_text, do_lower_case, verbose):
@@ -984,24 +1484,12 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose):
     # `pred_text` and `orig_text` to get a character-to-charcter alignment. This
     # can fail in certain cases in which case we just return `orig_text`.
 
-    def _strip_spaces(text):
-        ns_chars = []
-        ns_to_s_map = collections.OrderedDict()
-        for (i, c) in enumerate(text):
-            if c == " ":
-                continue
-            ns_to_s_map[len(ns_chars)] = i
-            ns_chars.append(c)
-        ns_text = "".join(ns_chars)
-        return ns_text, ns_to_s_map
-
     # We first tokenize `orig_text`, strip whitespace from the result
     # and `pred_text`, and check if they are the same length. If they are
     # NOT the same length, the heuristic has failed. If they are the same
     # length, we assume the characters are one-to-one aligned.
-    tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
-
-    tok_text = " ".join(tokenizer.tokenize(orig_text))
+    (tok_text, orig_ns_text, orig_ns_to_s_map,
+     tok_ns_text, tok_s_to_ns_map) = _align_orig_text(orig_text, do_lower_case)
 
     start_position = tok_text.find(pred_text)
     if start_position == -1:
@@ -1010,9 +1498,6 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose):
         return orig_text
     end_position = start_position + len(pred_text) - 1
 
-    (orig_ns_text, orig_ns_to_s_map) = _strip_spaces(orig_text)
-    (tok_ns_text, tok_ns_to_s_map) = _strip_spaces(tok_text)
-
     if len(orig_ns_text) != len(tok_ns_text):
         if verbose:
             logger.info("Length not equal after stripping spaces: '%s' vs '%s'",
@@ -1021,27 +1506,13 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose):
 
     # We then project the characters in `pred_text` back to `orig_text` using
     # the character-to-character alignment.
-    tok_s_to_ns_map = {}
-    for (i, tok_index) in six.iteritems(tok_ns_to_s_map):
-        tok_s_to_ns_map[tok_index] = i
-
-    orig_start_position = None
-    if start_position in tok_s_to_ns_map:
-        ns_start_position = tok_s_to_ns_map[start_position]
-        if ns_start_position in orig_ns_to_s_map:
-            orig_start_position = orig_ns_to_s_map[ns_start_position]
-
+    orig_start_position = _project_position(start_position, tok_s_to_ns_map, orig_ns_to_s_map)
     if orig_start_position is None:
         if verbose:
             logger.info("Couldn't map start position")
         return orig_text
 
-    orig_end_position = None
-    if end_position in tok_s_to_ns_map:
-        ns_end_position = tok_s_to_ns_map[end_position]
-        if ns_end_position in orig_ns_to_s_map:
-            orig_end_position = orig_ns_to_s_map[ns_end_position]
-
+    orig_end_position = _project_position(end_position, tok_s_to_ns_map, orig_ns_to_s_map)
     if orig_end_position is None:
         if verbose:
             logger.info("Couldn't map end position")
@@ -1053,15 +1524,27 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose):
 
 def _get_best_indexes(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(
-        enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i, score in enumerate(index_and_score):
-        if i >= n_best_size:
-            break
-        best_indexes.append(score[0])
-    return best_indexes
+    logits = np.asarray(logits)
+    if n_best_size <= 0:
+        return []
+    if n_best_size < len(logits):
+        # keep every logit tied with the n-th best one, so that the stable
+        # sort below picks the same indexes as a full sort would
+        kth = len(logits) - n_best_size
+        threshold = np.partition(logits, kth)[kth]
+        candidates = np.flatnonzero(logits >= threshold)
+    else:
+        candidates = np.arange(len(logits))
+    order = np.argsort(-logits[candidates], kind='stable')
+    return candidates[order[:n_best_size]].tolist()
+
+
+def _stack_logits(rows):
+    """Stacks logit lists into a matrix, padding shorter rows with -inf."""
+    logits = np.full((len(rows), max((len(row) for row in rows), default=0)), -np.inf)
+    for (i, row) in enumerate(rows):
+        logits[i, :len(row)] = row
+    return logits
 
 
 def _compute_softmax(scores):
@@ -1069,19 +1552,9 @@ def _compute_softmax(scores):
     if not scores:
         return []
 
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probs = []
-    for score in exp_scores:
-        probs.append(score / total_sum)
-    return probs
+    # one fresh buffer, then the shift, exp and normalisation all run in place
+    probs = np.array(scores, dtype=np.float64)
+    probs -= probs.max()
+    np.exp(probs, out=probs)
+    probs /= probs.sum()
+    return probs.tolist()
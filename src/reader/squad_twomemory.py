@@ -23,7 +23,7 @@ import pickle
 import logging
 import six
 import src.reader.tokenization as tokenization
-from src.reader.batching_twomemory import prepare_batch_data
+from src.reader.batching_twomemory import new_batch, add_to_batch, prepare_batch_data
 from src.reader.squad_v1_official_evaluate import evaluate
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -123,17 +123,21 @@ def read_squad_examples(input_file, is_training, version_2_with_negative=False):
             paragraph_text = paragraph["context"]
             doc_tokens = []
             char_to_word_offset = []
-            prev_is_whitespace = True
-            for c in paragraph_text:
+            # tokens are sliced out of the paragraph once their end is reached,
+            # rather than grown one character at a time
+            token_start = -1
+            for (i, c) in enumerate(paragraph_text):
                 if is_whitespace(c):
-                    prev_is_whitespace = True
+                    if token_start >= 0:
+                        doc_tokens.append(paragraph_text[token_start:i])
+                        token_start = -1
+                    char_to_word_offset.append(len(doc_tokens) - 1)
                 else:
-                    if prev_is_whitespace:
-                        doc_tokens.append(c)
-                    else:
-                        doc_tokens[-1] += c
-                    prev_is_whitespace = False
-                char_to_word_offset.append(len(doc_tokens) - 1)
+                    if token_start < 0:
+                        token_start = i
+                    char_to_word_offset.append(len(doc_tokens))
+            if token_start >= 0:
+                doc_tokens.append(paragraph_text[token_start:])
 
             for qa in paragraph["qas"]:
                 qas_id = qa["id"]
@@ -654,31 +658,29 @@ class DataProcessor:
                 "Unknown phase, which should be in ['train', 'predict'].")
 
         def batch_reader(features, batch_size, in_tokens):
-            batch, total_token_num, max_len = [], 0, 0
+            batch, batch_len, total_token_num, max_len = new_batch(), 0, 0, 0
             for (index, feature) in enumerate(features):
                 if phase == 'train':
                     self.current_train_example = index + 1
                 seq_len = len(feature.input_ids)
-                labels = [feature.unique_id] if feature.start_position is None else [feature.start_position,
-                                                                                     feature.end_position]
-                example = [feature.input_ids, feature.segment_ids, range(384), feature.wn_concept_ids,
-                           feature.nell_concept_ids] + labels
+                labels = (feature.unique_id,) if feature.start_position is None else (feature.start_position,
+                                                                                      feature.end_position)
                 max_len = max(max_len, seq_len)
 
                 # max_len = max(max_len, len(token_ids))
                 if in_tokens:
-                    to_append = (len(batch) + 1) * max_len <= batch_size
+                    to_append = (batch_len + 1) * max_len <= batch_size
                 else:
-                    to_append = len(batch) < batch_size
+                    to_append = batch_len < batch_size
 
-                if to_append:
-                    batch.append(example)
-                    total_token_num += seq_len
-                else:
+                if not to_append:
                     yield batch, total_token_num
-                    batch, total_token_num, max_len = [example
-                                                       ], seq_len, seq_len
-            if batch:
+                    batch, batch_len, total_token_num, max_len = new_batch(), 0, 0, seq_len
+                add_to_batch(batch, feature.input_ids, feature.segment_ids, range(384), feature.wn_concept_ids,
+                             feature.nell_concept_ids, labels)
+                batch_len += 1
+                total_token_num += seq_len
+            if batch_len:
                 yield batch, total_token_num
 
         if phase == 'train':